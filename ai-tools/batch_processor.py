@@ -4,23 +4,38 @@ Batch Processor for VMAP Images
 Handles batch uploads, processing, and organization of panoramic images
 """
 
+import errno
 import os
+import re
 import shutil
 import argparse
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import asdict
 from pathlib import Path
-from typing import List, Dict
+from typing import Callable, Dict, Iterator, List, Tuple
 import json
 from datetime import datetime
 from tqdm import tqdm
 import cv2
 import numpy as np
+from PIL import Image
+from feature_classifier import DECODE_SCALE, FeatureClassifier, Features
+
+# Sequence numbers are underscore-delimited runs of digits, e.g. IMG_20251006_185539_00_002
+_LAST_DIGIT_PART = re.compile(r'^(?:.*_)?(\d+)(?:_|$)')
+_FIRST_DIGIT_PART = re.compile(r'(?:^|_)(\d+)(?=_|$)')
 
 
 class BatchProcessor:
     """Process multiple images in batch"""
 
-    def __init__(self, input_dir: str, output_dir: str = None):
-        self.input_dir = Path(input_dir)
+    # Rows per append-only summary shard
+    SHARD_SIZE = 100
+
+    def __init__(self, input_dir: str = None, output_dir: str = None):
+        # input_dir may be omitted when only working on existing output (coalescing, organizing)
+        self.input_dir = Path(input_dir) if input_dir else None
         self.output_dir = Path(output_dir) if output_dir else Path('./processed_images')
         self.output_dir.mkdir(parents=True, exist_ok=True)
 
@@ -29,16 +44,34 @@ class BatchProcessor:
         self.metadata_dir = self.output_dir / 'metadata'
         self.thumbnails_dir = self.output_dir / 'thumbnails'
 
-        for dir_path in [self.categorized_dir, self.metadata_dir, self.thumbnails_dir]:
+        for dir_path in [self.categorized_dir, self.thumbnails_dir]:
             dir_path.mkdir(parents=True, exist_ok=True)
 
-    def process_batch(self, rename: bool = False, generate_thumbnails: bool = True) -> Dict:
+        # One classifier is shared by every image (and pickled once per worker task)
+        self.classifier = FeatureClassifier()
+
+        # One JSON line per processed image, accumulated across runs
+        self.metadata_log = self.output_dir / 'metadata.jsonl'
+
+        # Per-file summary rows are flushed here as the batch progresses
+        self.summary_file = self.output_dir / 'processing_summary.json'
+        self.shards_dir = self.output_dir / 'summary_shards'
+        self.shards_dir.mkdir(exist_ok=True)
+
+        # Date stamps are fixed per batch run (refreshed by process_batch)
+        self._today = datetime.now().strftime('%Y%m%d')
+        self._run_started = datetime.now().isoformat()
+
+    def process_batch(self, rename: bool = False, generate_thumbnails: bool = True,
+                      workers: int = None, per_image_metadata: bool = False) -> Dict:
         """
         Process all images in the input directory
 
         Args:
             rename: Whether to rename images based on detected features
             generate_thumbnails: Whether to generate thumbnail images
+            workers: Number of worker processes (defaults to the CPU count)
+            per_image_metadata: Also write a {stem}.json file per image to the metadata directory
 
         Returns:
             Summary of processing results
@@ -46,31 +79,80 @@ class BatchProcessor:
         image_files = self._find_images()
         print(f"Found {len(image_files)} images to process")
 
+        # Stamp every file of this run with the same date instead of asking the clock per image
+        now = datetime.now()
+        self._today = now.strftime('%Y%m%d')
+        self._run_started = now.isoformat()
+
+        # Shards describe a single run; drop any left over from earlier ones
+        for old_shard in self.shards_dir.glob('summary_shard_*.jsonl'):
+            old_shard.unlink()
+
+        # Per-file results are stored column-wise; numeric columns are preallocated
+        count = len(image_files)
         results = {
-            'total': len(image_files),
+            'total': count,
             'processed': 0,
             'errors': 0,
             'categories': {},
-            'files': []
+            'shards': [],
+            'files': {
+                'filename': [],
+                'category': [],
+                'width': np.empty(count, np.int32),
+                'height': np.empty(count, np.int32),
+                'file_size': np.empty(count, np.int64)
+            }
         }
 
-        for img_file in tqdm(image_files, desc="Processing images"):
-            try:
-                file_info = self._process_single_image(
-                    img_file,
-                    rename=rename,
-                    generate_thumbnails=generate_thumbnails
-                )
+        # Each image is independent, so fan the CPU-bound work out across processes.
+        # With a single worker, decode ahead on threads instead to overlap I/O with compute.
+        workers = workers or os.cpu_count()
+        if workers > 1:
+            jobs = self._run_in_pool(image_files, rename, generate_thumbnails, workers)
+        else:
+            jobs = self._run_prefetched(image_files, rename, generate_thumbnails)
+
+        # Results arrive in submission order and are aggregated here; metadata is
+        # appended to a single line-buffered log instead of one file per image
+        if per_image_metadata:
+            self.metadata_dir.mkdir(exist_ok=True)
+        with open(self.metadata_log, 'a', buffering=1) as metadata_log:
+            for img_file, job in tqdm(jobs, total=len(image_files), desc="Processing images"):
+                try:
+                    file_info = job()
+                except Exception as e:
+                    tqdm.write(f"Error processing {img_file.name}: {e}")
+                    results['errors'] += 1
+                    continue
+
+                metadata_log.write(json.dumps(file_info) + '\n')
+                if per_image_metadata:
+                    with open(self.metadata_dir / f"{img_file.stem}.json", 'w') as f:
+                        json.dump(file_info, f, indent=2)
+
+                files = results['files']
+                row = results['processed']
+                files['filename'].append(file_info['filename'])
+                files['category'].append(file_info['category'])
+                files['width'][row] = file_info['dimensions']['width']
+                files['height'][row] = file_info['dimensions']['height']
+                files['file_size'][row] = file_info['file_size']
                 results['processed'] += 1
-                results['files'].append(file_info)
 
-                # Count categories
-                category = file_info.get('category', 'unknown')
-                results['categories'][category] = results['categories'].get(category, 0) + 1
+                # Flush finished rows so progress survives a crash mid-batch
+                if results['processed'] % self.SHARD_SIZE == 0:
+                    self._write_shard(results)
+
+        if results['processed'] % self.SHARD_SIZE:
+            self._write_shard(results)
 
-            except Exception as e:
-                print(f"Error processing {img_file.name}: {e}")
-                results['errors'] += 1
+        # Rows past the processed count were never filled (failed images)
+        for name in ('width', 'height', 'file_size'):
+            results['files'][name] = results['files'][name][:results['processed']]
+
+        # Count categories
+        results['categories'] = dict(Counter(results['files']['category']))
 
         # Save processing summary
         self._save_summary(results)
@@ -82,19 +164,67 @@ class BatchProcessor:
         extensions = {'.jpg', '.jpeg', '.png', '.bmp'}
         return sorted([f for f in self.input_dir.glob('*') if f.suffix.lower() in extensions])
 
-    def _process_single_image(self, img_path: Path, rename: bool, generate_thumbnails: bool) -> Dict:
-        """Process a single image file"""
-        # Load image
-        img = cv2.imread(str(img_path))
+    def _run_in_pool(self, image_files: List[Path], rename: bool, generate_thumbnails: bool,
+                     workers: int) -> Iterator[Tuple[Path, Callable[[], Dict]]]:
+        """Yield (path, job) pairs whose jobs wait on worker processes"""
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(self._process_single_image, img_file, rename, generate_thumbnails)
+                for img_file in image_files
+            ]
+            for img_file, future in zip(image_files, futures):
+                yield img_file, future.result
+
+    def _run_prefetched(self, image_files: List[Path], rename: bool, generate_thumbnails: bool,
+                        lookahead: int = 8) -> Iterator[Tuple[Path, Callable[[], Dict]]]:
+        """Yield (path, job) pairs processed in-process while threads decode up to lookahead images ahead"""
+        def job(img_file, decoded):
+            return lambda: self._process_single_image(
+                img_file, rename, generate_thumbnails, img=decoded.result()
+            )
+
+        with ThreadPoolExecutor(max_workers=4) as loader:
+            pending = deque()
+            for img_file in image_files:
+                pending.append((img_file, loader.submit(self._load_image, img_file)))
+                if len(pending) > lookahead:
+                    img_file, decoded = pending.popleft()
+                    yield img_file, job(img_file, decoded)
+
+            while pending:
+                img_file, decoded = pending.popleft()
+                yield img_file, job(img_file, decoded)
+
+    def _load_image(self, img_path: Path) -> np.ndarray:
+        """
+        Read an image file in one call and decode it from memory
+
+        Only statistics and a thumbnail are derived from the pixels, so JPEGs are
+        decoded at half resolution (DECODE_SCALE), letting libjpeg skip most of the IDCT work.
+        """
+        img = cv2.imdecode(np.fromfile(str(img_path), dtype=np.uint8), cv2.IMREAD_REDUCED_COLOR_2)
         if img is None:
             raise ValueError(f"Could not load image: {img_path}")
+        return img
 
-        # Extract basic info
-        height, width = img.shape[:2]
+    def _process_single_image(self, img_path: Path, rename: bool, generate_thumbnails: bool,
+                              img: np.ndarray = None) -> Dict:
+        """Process a single image file, optionally reusing an already decoded image"""
+        # Load image
+        if img is None:
+            img = self._load_image(img_path)
+
+        # Extract basic info (the decode is reduced, so read dimensions from the header;
+        # cv2 applies the EXIF orientation, and orientations 5-8 swap the axes)
+        with Image.open(img_path) as header:
+            width, height = header.size
+            if header.getexif().get(0x0112, 1) in (5, 6, 7, 8):
+                width, height = height, width
         file_size = img_path.stat().st_size
 
-        # Detect features and categorize
-        category = self._categorize_image(img)
+        # Detect features once; both the category and the richer classification derive from them
+        features, space_type, confidence, details = self.classifier.analyze(img, DECODE_SCALE)
+        category = self._categorize_image(features)
 
         # Generate new filename if renaming
         if rename:
@@ -106,9 +236,20 @@ class BatchProcessor:
         category_dir = self.categorized_dir / category
         category_dir.mkdir(exist_ok=True)
 
-        # Copy to categorized directory
+        # Hardlink into the categorized directory, copying only where links aren't possible.
+        # Build the entry under a per-process temporary name and rename it into place: an
+        # existing destination may be a hardlink to another input, so it is replaced, never
+        # written through.
         dest_path = category_dir / new_name
-        shutil.copy2(img_path, dest_path)
+        tmp_path = category_dir / f".{new_name}.{os.getpid()}.tmp"
+        tmp_path.unlink(missing_ok=True)
+        try:
+            os.link(img_path, tmp_path)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM):
+                raise
+            shutil.copy2(img_path, tmp_path)
+        os.replace(tmp_path, dest_path)
 
         # Generate thumbnail
         thumbnail_path = None
@@ -123,20 +264,21 @@ class BatchProcessor:
             'category': category,
             'dimensions': {'width': width, 'height': height},
             'file_size': file_size,
+            'features': asdict(features),
+            'classification': {
+                'category': space_type,
+                'confidence': confidence,
+                'details': details
+            },
             'thumbnail': str(thumbnail_path) if thumbnail_path else None,
-            'processed_at': datetime.now().isoformat()
+            'processed_at': self._run_started
         }
 
-        # Save metadata
-        metadata_file = self.metadata_dir / f"{img_path.stem}.json"
-        with open(metadata_file, 'w') as f:
-            json.dump(metadata, f, indent=2)
-
         return metadata
 
-    def _categorize_image(self, img: np.ndarray) -> str:
+    def _categorize_image(self, features: Features) -> str:
         """
-        Categorize image based on visual features
+        Categorize image based on visual features shared with FeatureClassifier
 
         Categories:
         - hallway: Long corridors
@@ -146,46 +288,25 @@ class BatchProcessor:
         - common_area: Open spaces
         - unknown: Unclassified
         """
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-
-        # Calculate various metrics
-        edges = cv2.Canny(gray, 50, 150)
-        edge_density = np.sum(edges > 0) / edges.size
-
-        # Detect lines (corridors tend to have strong horizontal/vertical lines)
-        lines = cv2.HoughLinesP(edges, 1, np.pi/180, threshold=100, minLineLength=100, maxLineGap=10)
-        line_count = len(lines) if lines is not None else 0
-
-        # Brightness analysis
-        brightness = np.mean(gray)
-
         # Simple rule-based classification
         # In production, this would use a trained neural network
-        if edge_density > 0.2 and line_count > 50:
+        if features.edge_density > 0.2 and features.line_count > 50:
             return 'hallway'
-        elif edge_density < 0.1:
+        elif features.edge_density < 0.1:
             return 'common_area'
-        elif brightness < 80:
+        elif features.brightness < 80:
             return 'dark_area'
         else:
             return 'corridor'
 
     def _generate_filename(self, original_path: Path, category: str) -> str:
         """Generate a descriptive filename"""
-        # Extract sequence number if present
-        stem = original_path.stem
-        parts = stem.split('_')
-
-        # Try to find sequence number
-        sequence = '000'
-        for part in reversed(parts):
-            if part.isdigit():
-                sequence = part.zfill(3)
-                break
+        # Extract sequence number if present (last all-digit part of the stem)
+        match = _LAST_DIGIT_PART.match(original_path.stem)
+        sequence = match.group(1).zfill(3) if match else '000'
 
         # Create new filename
-        timestamp = datetime.now().strftime('%Y%m%d')
-        new_name = f"{category}_{sequence}_{timestamp}{original_path.suffix}"
+        new_name = f"{category}_{sequence}_{self._today}{original_path.suffix}"
 
         return new_name
 
@@ -193,15 +314,65 @@ class BatchProcessor:
         """Generate a thumbnail image"""
         thumbnail = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
         thumbnail_path = self.thumbnails_dir / f"thumb_{filename}"
-        cv2.imwrite(str(thumbnail_path), thumbnail)
+        cv2.imwrite(str(thumbnail_path), thumbnail, [cv2.IMWRITE_JPEG_QUALITY, 80])
         return thumbnail_path
 
+    def _write_shard(self, results: Dict):
+        """Append the rows processed since the last shard as a new JSONL shard and index it"""
+        start = len(results['shards']) * self.SHARD_SIZE
+        end = results['processed']
+        rows = {
+            name: column[start:end].tolist() if isinstance(column, np.ndarray) else column[start:end]
+            for name, column in results['files'].items()
+        }
+
+        shard_name = f"summary_shard_{len(results['shards']):05d}.jsonl"
+        with open(self.shards_dir / shard_name, 'w') as f:
+            for values in zip(*rows.values()):
+                f.write(json.dumps(dict(zip(rows, values)), separators=(',', ':')) + '\n')
+
+        results['shards'].append(shard_name)
+
+        # Keep the index current so the shards written so far are found after a crash
+        self._write_index(results)
+
+    def _write_index(self, results: Dict):
+        """Write the summary index (everything but the per-file rows, which live in shards)"""
+        summary = {key: value for key, value in results.items() if key != 'files'}
+        with open(self.summary_file, 'w') as f:
+            json.dump(summary, f, indent=2)
+
     def _save_summary(self, results: Dict):
-        """Save processing summary to JSON"""
-        summary_file = self.output_dir / 'processing_summary.json'
-        with open(summary_file, 'w') as f:
-            json.dump(results, f, indent=2)
-        print(f"\nProcessing summary saved to: {summary_file}")
+        """Save processing summary to JSON (an index of the shards holding per-file rows)"""
+        self._write_index(results)
+        print(f"\nProcessing summary saved to: {self.summary_file}")
+
+    def coalesce_summary(self):
+        """
+        Merge the summary shards into the 'files' columns of the summary index
+
+        Works on the output of an interrupted run too: every shard on disk is merged and the
+        category counts are recomputed from the merged rows.
+        """
+        summary = {}
+        if self.summary_file.exists():
+            with open(self.summary_file) as f:
+                summary = json.load(f)
+
+        shard_names = sorted(path.name for path in self.shards_dir.glob('summary_shard_*.jsonl'))
+        files = {}
+        for shard_name in shard_names:
+            with open(self.shards_dir / shard_name) as f:
+                for line in f:
+                    for name, value in json.loads(line).items():
+                        files.setdefault(name, []).append(value)
+
+        summary['shards'] = shard_names
+        summary['categories'] = dict(Counter(files.get('category', [])))
+        summary['files'] = files
+        with open(self.summary_file, 'w') as f:
+            json.dump(summary, f, separators=(',', ':'))
+        print(f"Coalesced {len(shard_names)} summary shards into: {self.summary_file}")
 
     def organize_by_sequence(self):
         """Organize images by sequence number"""
@@ -210,13 +381,7 @@ class BatchProcessor:
         sequence_dir = self.output_dir / 'by_sequence'
         sequence_dir.mkdir(exist_ok=True)
 
-        # Read all metadata files
-        metadata_files = list(self.metadata_dir.glob('*.json'))
-
-        for meta_file in metadata_files:
-            with open(meta_file) as f:
-                metadata = json.load(f)
-
+        for metadata in self._iter_metadata():
             # Extract sequence from filename
             filename = metadata['filename']
             # Create sequence-based subdirectory structure
@@ -235,42 +400,66 @@ class BatchProcessor:
 
         print(f"Images organized by sequence in: {sequence_dir}")
 
+    def _iter_metadata(self) -> Iterator[Dict]:
+        """Yield per-image metadata from the batch log, or from per-image files of older runs"""
+        if self.metadata_log.exists():
+            with open(self.metadata_log) as f:
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+            return
+
+        for meta_file in self.metadata_dir.glob('*.json'):
+            with open(meta_file) as f:
+                yield json.load(f)
+
     def _extract_sequence(self, filename: str) -> int:
         """Extract sequence number from filename"""
-        parts = filename.split('_')
-        for part in parts:
-            if part.isdigit():
-                return int(part)
-        return None
+        match = _FIRST_DIGIT_PART.search(filename)
+        return int(match.group(1)) if match else None
 
 
 def main():
     parser = argparse.ArgumentParser(description='Batch process panoramic images')
-    parser.add_argument('--input', type=str, required=True, help='Input directory with images')
+    parser.add_argument('--input', type=str, help='Input directory with images (omit to only --coalesce/--organize)')
     parser.add_argument('--output', type=str, help='Output directory for processed images')
     parser.add_argument('--rename', action='store_true', help='Rename images based on features')
     parser.add_argument('--no-thumbnails', action='store_true', help='Skip thumbnail generation')
     parser.add_argument('--organize', action='store_true', help='Organize by sequence')
+    parser.add_argument('--workers', type=int, help='Number of worker processes (default: CPU count)')
+    parser.add_argument('--per-image-metadata', action='store_true',
+                        help='Also write one metadata JSON file per image')
+    parser.add_argument('--coalesce', action='store_true',
+                        help='Merge summary shards into processing_summary.json')
 
     args = parser.parse_args()
+    if not (args.input or args.coalesce or args.organize):
+        parser.error('--input is required unless only running --coalesce or --organize')
 
     processor = BatchProcessor(args.input, args.output)
 
     # Process batch
-    results = processor.process_batch(
-        rename=args.rename,
-        generate_thumbnails=not args.no_thumbnails
-    )
-
-    print(f"\n{'='*60}")
-    print(f"Processing Complete!")
-    print(f"{'='*60}")
-    print(f"Total images: {results['total']}")
-    print(f"Processed: {results['processed']}")
-    print(f"Errors: {results['errors']}")
-    print(f"\nCategories:")
-    for category, count in results['categories'].items():
-        print(f"  {category}: {count}")
+    if args.input:
+        results = processor.process_batch(
+            rename=args.rename,
+            generate_thumbnails=not args.no_thumbnails,
+            workers=args.workers,
+            per_image_metadata=args.per_image_metadata
+        )
+
+        print(f"\n{'='*60}")
+        print(f"Processing Complete!")
+        print(f"{'='*60}")
+        print(f"Total images: {results['total']}")
+        print(f"Processed: {results['processed']}")
+        print(f"Errors: {results['errors']}")
+        print(f"\nCategories:")
+        for category, count in results['categories'].items():
+            print(f"  {category}: {count}")
+
+    # Merge summary shards if requested
+    if args.coalesce:
+        processor.coalesce_summary()
 
     # Organize by sequence if requested
     if args.organize:
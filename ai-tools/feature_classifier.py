@@ -10,7 +10,66 @@ from pathlib import Path
 from typing import Dict, List, Tuple
 import cv2
 import numpy as np
-from collections import defaultdict
+from collections import Counter
+from dataclasses import asdict, dataclass, fields
+from tqdm import tqdm
+
+# Feature statistics are computed at this working resolution (longest side, pixels).
+# Door contours and line segments stop matching the full-resolution counts the rules
+# were written for much below a quarter of a 12k panorama, so don't go lower than this
+ANALYSIS_MAX_SIDE = 3072
+
+# Edges on the reduced image are less fragmented, so Hough with plainly scaled votes and
+# length finds ~3x as many segments; doubling both brings line counts back in line with
+# full-resolution values
+HOUGH_SCALE_FACTOR = 2.0
+
+# Images are decoded at half resolution (IMREAD_REDUCED_COLOR_2); pixel thresholds are
+# defined for the full-resolution image, so this factor is folded into their scale
+DECODE_SCALE = 0.5
+
+
+def _downscale_for_analysis(img: np.ndarray) -> Tuple[np.ndarray, float]:
+    """Shrink img by the smallest integer factor that brings its longest side to at most
+    ANALYSIS_MAX_SIDE; returns (img, scale)"""
+    height, width = img.shape[:2]
+    factor = -(-max(height, width) // ANALYSIS_MAX_SIDE)
+    if factor <= 1:
+        return img, 1.0
+    # An integer factor keeps INTER_AREA a plain box filter, which preserves the thin
+    # edge structure door/line detection depends on better than a fractional resize
+    size = (max(1, width // factor), max(1, height // factor))
+    return cv2.resize(img, size, interpolation=cv2.INTER_AREA), 1.0 / factor
+
+
+def _count_line_orientations(lines: np.ndarray) -> Tuple[int, int]:
+    """Count (vertical, horizontal) segments in an (N, 4) array of x1, y1, x2, y2"""
+    dx = (lines[:, 2] - lines[:, 0]).astype(np.float32)
+    dy = (lines[:, 3] - lines[:, 1]).astype(np.float32)
+    angles = np.abs(np.degrees(np.arctan2(dy, dx)))
+
+    vertical = np.count_nonzero((angles > 80) & (angles < 100))
+    horizontal = np.count_nonzero((angles < 10) | (angles > 170))
+    return int(vertical), int(horizontal)
+
+
+@dataclass(slots=True)
+class Features:
+    """Visual statistics extracted from one image"""
+    edge_density: float = 0.0
+    line_count: int = 0
+    vertical_lines: int = 0
+    horizontal_lines: int = 0
+    door_count: int = 0
+    brightness: float = 0.0
+    contrast: float = 0.0
+    symmetry: float = 0.0
+    saturation: float = 0.0
+    value: float = 0.0
+
+
+# Column order of feature vectors used by FeatureClassifier's rule matrices
+FEATURE_NAMES = [f.name for f in fields(Features)]
 
 
 class FeatureClassifier:
@@ -27,6 +86,28 @@ class FeatureClassifier:
         'unknown': 'Unclassified space'
     }
 
+    # Rule-based classification: (category, score, {feature: (lower, upper)}).
+    # Bounds are exclusive and None means unbounded; a category scores the highest
+    # value among its rules whose bounds all hold.
+    RULES = [
+        # Hallway: High line count, high vertical lines, moderate edge density
+        ('hallway', 0.8, {'line_count': (50, None), 'vertical_lines': (20, None),
+                          'edge_density': (0.15, None)}),
+        # Corridor with doors: Multiple doors detected
+        ('hallway', 0.75, {'door_count': (2, None)}),
+        # Classroom: Moderate complexity, lower symmetry
+        ('classroom', 0.6, {'edge_density': (0.1, 0.2), 'symmetry': (None, 0.5),
+                            'contrast': (50, None)}),
+        # Common area: Low edge density, high brightness
+        ('common_area', 0.7, {'edge_density': (None, 0.1), 'brightness': (150, None)}),
+        # Doorway: Focused on doors (door_count >= 1), high symmetry
+        ('doorway', 0.65, {'door_count': (0, None), 'symmetry': (0.6, None)}),
+        # Stairwell: Many lines, high edge density
+        ('stairwell', 0.7, {'line_count': (80, None), 'edge_density': (0.25, None)}),
+        # Lab/Office: Moderate everything
+        ('office', 0.5, {'edge_density': (0.12, 0.18), 'saturation': (None, 100)}),
+    ]
+
     def __init__(self):
         self.feature_weights = {
             'edge_density': 1.0,
@@ -39,6 +120,22 @@ class FeatureClassifier:
             'symmetry': 1.1
         }
 
+        # Compile RULES into bound matrices (rules x features) and a score matrix
+        # (rules x categories) so classification is a few array operations
+        self._rule_categories = list(dict.fromkeys(category for category, _, _ in self.RULES))
+        self._rule_lower = np.full((len(self.RULES), len(FEATURE_NAMES)), -np.inf)
+        self._rule_upper = np.full((len(self.RULES), len(FEATURE_NAMES)), np.inf)
+        self._rule_scores = np.zeros((len(self.RULES), len(self._rule_categories)))
+
+        for r, (category, score, bounds) in enumerate(self.RULES):
+            self._rule_scores[r, self._rule_categories.index(category)] = score
+            for name, (lower, upper) in bounds.items():
+                f = FEATURE_NAMES.index(name)
+                if lower is not None:
+                    self._rule_lower[r, f] = lower
+                if upper is not None:
+                    self._rule_upper[r, f] = upper
+
     def classify(self, image_path: str) -> Dict:
         """
         Classify an image into a category
@@ -49,65 +146,127 @@ class FeatureClassifier:
         Returns:
             Dictionary with classification results
         """
-        img = cv2.imread(image_path)
-        if img is None:
-            raise ValueError(f"Could not load image: {image_path}")
+        img = self._load_image(image_path)
 
         # Extract features
-        features = self._extract_features(img)
+        features = self._extract_features(img, DECODE_SCALE)
 
         # Classify based on features
         category, confidence = self._classify_from_features(features)
 
+        return self._build_result(Path(image_path).name, features, category, confidence)
+
+    def analyze(self, img: np.ndarray, decode_scale: float = 1.0) -> Tuple[Features, str, float, Dict]:
+        """
+        Extract features from an already decoded image and classify them
+
+        Args:
+            img: BGR image
+            decode_scale: Size of img relative to the full-resolution file (e.g. DECODE_SCALE)
+
+        Returns:
+            Tuple of (features, category, confidence, details)
+        """
+        features = self._extract_features(img, decode_scale)
+        category, confidence = self._classify_from_features(features)
+        return features, category, confidence, self._analyze_space_type(features)
+
+    def _load_image(self, image_path: str) -> np.ndarray:
+        """Load an image for feature extraction"""
+        # Only statistics are needed, so let libjpeg decode at half resolution (DECODE_SCALE)
+        img = cv2.imread(image_path, cv2.IMREAD_REDUCED_COLOR_2)
+        if img is None:
+            raise ValueError(f"Could not load image: {image_path}")
+        return img
+
+    def _build_result(self, filename: str, features: Features, category: str,
+                      confidence: float) -> Dict:
+        """Assemble the classification result for one image"""
         # Get detailed analysis
         details = self._analyze_space_type(features)
 
         return {
-            'filename': Path(image_path).name,
+            'filename': filename,
             'category': category,
             'confidence': confidence,
-            'features': features,
+            'features': asdict(features),
             'details': details,
             'description': self.CATEGORIES.get(category, 'Unknown')
         }
 
-    def _extract_features(self, img: np.ndarray) -> Dict:
-        """Extract visual features from image"""
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        height, width = img.shape[:2]
+    def _extract_features(self, img: np.ndarray, decode_scale: float = 1.0) -> Features:
+        """
+        Extract visual features from image
 
-        features = {}
+        Args:
+            img: BGR image
+            decode_scale: Size of img relative to the full-resolution file (e.g. DECODE_SCALE)
+        """
+        # Only statistics are needed, so work on a downscaled copy
+        img, scale = _downscale_for_analysis(img)
+        scale *= decode_scale
+
+        # Keep intermediates in UMat so OpenCV's T-API can dispatch to OpenCL
+        u = cv2.UMat(img)
+        gray_u = cv2.cvtColor(u, cv2.COLOR_BGR2GRAY)
 
         # Edge detection
-        edges = cv2.Canny(gray, 50, 150)
-        features['edge_density'] = np.sum(edges > 0) / edges.size
+        edges_u = cv2.Canny(gray_u, 50, 150)
+
+        return self._compute_all_features(u, gray_u, edges_u, scale)
+
+    def _compute_all_features(self, u: cv2.UMat, gray_u: cv2.UMat, edges_u: cv2.UMat,
+                              scale: float) -> Features:
+        """
+        Compute every feature statistic from one BGR/gray/Canny triple
+
+        Args:
+            u: BGR image at working resolution
+            gray_u: Grayscale of u
+            edges_u: Canny edges of gray_u
+            scale: Factor the working image was resized by, used to scale pixel thresholds
+        """
+        # Download once for the Python-side contour and symmetry passes
+        gray = gray_u.get()
+        edges = edges_u.get()
+        height, width = gray.shape
+
+        features = Features()
+        # Canny edges stay ~1px wide at any resolution, so density grows as 1/scale;
+        # report the full-resolution equivalent the rules are written against
+        features.edge_density = cv2.countNonZero(edges_u) / float(height * width) * scale
 
         # Line detection
-        lines = cv2.HoughLinesP(edges, 1, np.pi/180, threshold=100, minLineLength=100, maxLineGap=10)
-        features['line_count'] = len(lines) if lines is not None else 0
+        hough_scale = min(1.0, HOUGH_SCALE_FACTOR * scale)
+        lines = cv2.HoughLinesP(edges_u, 1, np.pi/180, threshold=max(1, int(100 * hough_scale)),
+                                minLineLength=100 * hough_scale, maxLineGap=10)
+        lines = lines.get() if isinstance(lines, cv2.UMat) else lines
+        features.line_count = len(lines) if lines is not None else 0
 
         # Separate vertical and horizontal lines
         vertical_lines = 0
         horizontal_lines = 0
 
         if lines is not None:
-            for line in lines:
-                x1, y1, x2, y2 = line[0]
-                angle = np.abs(np.arctan2(y2 - y1, x2 - x1) * 180 / np.pi)
-
-                if angle > 80 and angle < 100:  # Vertical
-                    vertical_lines += 1
-                elif angle < 10 or angle > 170:  # Horizontal
-                    horizontal_lines += 1
+            vertical_lines, horizontal_lines = _count_line_orientations(lines.reshape(-1, 4))
 
-        features['vertical_lines'] = vertical_lines
-        features['horizontal_lines'] = horizontal_lines
+        features.vertical_lines = vertical_lines
+        features.horizontal_lines = horizontal_lines
 
         # Door detection (rectangles with specific aspect ratio)
         contours, _ = cv2.findContours(edges, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+        min_door_area = 5000 * scale ** 2
         door_count = 0
 
-        for contour in contours:
+        # An approximated polygon never has a larger bounding box than its contour,
+        # so small contours can be rejected up front without calling approxPolyDP
+        candidates = []
+        if contours:
+            boxes = np.array([cv2.boundingRect(c) for c in contours])
+            candidates = np.flatnonzero(boxes[:, 2] * boxes[:, 3] > min_door_area)
+
+        for i in candidates:
+            contour = contours[i]
             perimeter = cv2.arcLength(contour, True)
             approx = cv2.approxPolyDP(contour, 0.02 * perimeter, True)
 
@@ -116,14 +275,14 @@ class FeatureClassifier:
                 aspect_ratio = float(w) / h if h > 0 else 0
 
                 # Doors typically have aspect ratio between 0.3 and 0.7
-                if 0.3 < aspect_ratio < 0.7 and w * h > 5000:
+                if 0.3 < aspect_ratio < 0.7 and w * h > min_door_area:
                     door_count += 1
 
-        features['door_count'] = door_count
+        features.door_count = door_count
 
         # Brightness and contrast
-        features['brightness'] = np.mean(gray)
-        features['contrast'] = np.std(gray)
+        features.brightness = float(np.mean(gray))
+        features.contrast = float(np.std(gray))
 
         # Symmetry (compare left and right halves)
         left_half = gray[:, :width//2]
@@ -134,66 +293,58 @@ class FeatureClassifier:
         left_half = left_half[:, :min_width]
         right_half = right_half[:, :min_width]
 
-        symmetry_score = cv2.matchTemplate(left_half, right_half, cv2.TM_CCOEFF_NORMED)[0][0]
-        features['symmetry'] = float(symmetry_score)
-
-        # Color analysis
-        hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
-        features['saturation'] = np.mean(hsv[:, :, 1])
-        features['value'] = np.mean(hsv[:, :, 2])
+        # Pearson correlation of the mirrored halves at 1/2 scale (same statistic as
+        # TM_CCOEFF_NORMED on equal-sized inputs, on 4x less data)
+        half_size = (max(1, min_width // 2), max(1, height // 2))
+        left = cv2.resize(left_half, half_size, interpolation=cv2.INTER_AREA).astype(np.float32).ravel()
+        right = cv2.resize(right_half, half_size, interpolation=cv2.INTER_AREA).astype(np.float32).ravel()
+        left -= left.mean()
+        right -= right.mean()
+        symmetry_score = (left @ right) / (np.sqrt((left @ left) * (right @ right)) + 1e-9)
+        features.symmetry = float(symmetry_score)
+
+        # Color analysis (one pass over the interleaved HSV buffer)
+        hsv = cv2.cvtColor(u, cv2.COLOR_BGR2HSV)
+        _, mean_saturation, mean_value, _ = cv2.mean(hsv)
+        features.saturation = mean_saturation
+        features.value = mean_value
 
         return features
 
-    def _classify_from_features(self, features: Dict) -> Tuple[str, float]:
+    def _classify_from_features(self, features: Features) -> Tuple[str, float]:
         """
         Classify image based on extracted features
 
         Returns:
             (category, confidence_score)
         """
-        scores = defaultdict(float)
-
-        # Rule-based classification
-        # Hallway: High line count, high vertical lines, moderate edge density
-        if (features['line_count'] > 50 and
-            features['vertical_lines'] > 20 and
-            features['edge_density'] > 0.15):
-            scores['hallway'] = 0.8
+        return self._classify_many([features])[0]
 
-        # Corridor with doors: Multiple doors detected
-        if features['door_count'] > 2:
-            scores['hallway'] = max(scores['hallway'], 0.75)
+    def _classify_many(self, features_list: List[Features]) -> List[Tuple[str, float]]:
+        """
+        Classify a batch of feature sets with one vectorized pass over the rule table
 
-        # Classroom: Moderate complexity, lower symmetry
-        if (features['edge_density'] > 0.1 and features['edge_density'] < 0.2 and
-            features['symmetry'] < 0.5 and features['contrast'] > 50):
-            scores['classroom'] = 0.6
+        Returns:
+            List of (category, confidence_score), one per input
+        """
+        x = np.array([[getattr(f, name) for name in FEATURE_NAMES] for f in features_list],
+                     dtype=np.float64).reshape(-1, len(FEATURE_NAMES))
 
-        # Common area: Low edge density, high brightness
-        if features['edge_density'] < 0.1 and features['brightness'] > 150:
-            scores['common_area'] = 0.7
+        # fired[n, r]: every bound of rule r holds for image n
+        inside = (x[:, None, :] > self._rule_lower) & (x[:, None, :] < self._rule_upper)
+        fired = inside.all(axis=2)
 
-        # Doorway: Focused on doors, high symmetry
-        if features['door_count'] >= 1 and features['symmetry'] > 0.6:
-            scores['doorway'] = 0.65
+        # Each category takes its best firing rule; ties go to the earliest category
+        scores = (fired[:, :, None] * self._rule_scores).max(axis=1)
+        best = scores.argmax(axis=1)
+        confidence = scores[np.arange(len(best)), best]
 
-        # Stairwell: Many lines, high edge density
-        if features['line_count'] > 80 and features['edge_density'] > 0.25:
-            scores['stairwell'] = 0.7
+        return [
+            (self._rule_categories[b], float(c)) if c > 0 else ('unknown', 0.0)
+            for b, c in zip(best, confidence)
+        ]
 
-        # Lab/Office: Moderate everything
-        if (features['edge_density'] > 0.12 and features['edge_density'] < 0.18 and
-            features['saturation'] < 100):
-            scores['office'] = 0.5
-
-        # Get highest scoring category
-        if scores:
-            category = max(scores.items(), key=lambda x: x[1])
-            return category[0], category[1]
-        else:
-            return 'unknown', 0.0
-
-    def _analyze_space_type(self, features: Dict) -> Dict:
+    def _analyze_space_type(self, features: Features) -> Dict:
         """Provide detailed analysis of the space"""
         details = {
             'space_characteristics': [],
@@ -202,34 +353,34 @@ class FeatureClassifier:
         }
 
         # Analyze characteristics
-        if features['edge_density'] > 0.2:
+        if features.edge_density > 0.2:
             details['space_characteristics'].append('High architectural complexity')
-        elif features['edge_density'] < 0.1:
+        elif features.edge_density < 0.1:
             details['space_characteristics'].append('Simple, open space')
 
-        if features['symmetry'] > 0.6:
+        if features.symmetry > 0.6:
             details['space_characteristics'].append('Symmetrical layout')
 
-        if features['brightness'] > 150:
+        if features.brightness > 150:
             details['space_characteristics'].append('Well-lit area')
-        elif features['brightness'] < 80:
+        elif features.brightness < 80:
             details['space_characteristics'].append('Dimly lit area')
 
         # Detected elements
-        if features['door_count'] > 0:
-            details['detected_elements'].append(f"{features['door_count']} door(s)")
+        if features.door_count > 0:
+            details['detected_elements'].append(f"{features.door_count} door(s)")
 
-        if features['vertical_lines'] > 30:
+        if features.vertical_lines > 30:
             details['detected_elements'].append('Strong vertical structures')
 
-        if features['horizontal_lines'] > 20:
+        if features.horizontal_lines > 20:
             details['detected_elements'].append('Horizontal architectural elements')
 
         # Notes
-        if features['line_count'] > 100:
+        if features.line_count > 100:
             details['notes'].append('Complex architectural features')
 
-        if features['contrast'] > 70:
+        if features.contrast > 70:
             details['notes'].append('High contrast environment')
 
         return details
@@ -253,13 +404,26 @@ class FeatureClassifier:
 
         print(f"Classifying {len(image_files)} images...")
 
-        for img_file in image_files:
+        extracted = []
+        for img_file in tqdm(image_files, desc="Extracting features"):
             try:
-                result = self.classify(str(img_file))
-                results.append(result)
-                print(f"{img_file.name}: {result['category']} ({result['confidence']:.2f})")
+                features = self._extract_features(self._load_image(str(img_file)), DECODE_SCALE)
+                extracted.append((img_file, features))
             except Exception as e:
-                print(f"Error classifying {img_file.name}: {e}")
+                tqdm.write(f"Error classifying {img_file.name}: {e}")
+
+        # Score every image against the rule table in one pass
+        labels = self._classify_many([features for _, features in extracted])
+
+        lines = []
+        for (img_file, features), (category, confidence) in zip(extracted, labels):
+            result = self._build_result(img_file.name, features, category, confidence)
+            results.append(result)
+            lines.append(f"{img_file.name}: {result['category']} ({result['confidence']:.2f})")
+
+        # Report every image in one write rather than flushing a line per file
+        if lines:
+            print('\n'.join(lines))
 
         # Save results
         if output_file:
@@ -268,9 +432,7 @@ class FeatureClassifier:
             print(f"\nResults saved to: {output_file}")
 
         # Print summary
-        category_counts = defaultdict(int)
-        for result in results:
-            category_counts[result['category']] += 1
+        category_counts = Counter(result['category'] for result in results)
 
         print("\nClassification Summary:")
         for category, count in sorted(category_counts.items()):
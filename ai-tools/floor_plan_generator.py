@@ -6,15 +6,26 @@ Generates top-down floor plan visualization from panoramic image sequence
 
 import argparse
 import json
+import textwrap
 from pathlib import Path
-from typing import List, Dict, Tuple
+from typing import List, Dict
 import cv2
 import numpy as np
-import matplotlib.pyplot as plt
 import matplotlib.patches as patches
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from matplotlib.lines import Line2D
 from matplotlib.patches import FancyBboxPatch, Circle, Rectangle
 from matplotlib.collections import LineCollection
 
+# Auto layout: size of the visual-word vocabulary, nearest neighbours looked up per image,
+# cosine similarity at which two images count as the same place, and how many frames apart
+# they must be (closer frames look alike simply because they were taken one after another)
+VOCABULARY_SIZE = 64
+SIMILAR_NEIGHBOURS = 5
+SIMILARITY_THRESHOLD = 0.9
+MIN_REVISIT_GAP = 5
+
 
 class FloorPlanGenerator:
     """Generate floor plan visualizations from panoramic images"""
@@ -22,7 +33,7 @@ class FloorPlanGenerator:
     def __init__(self, image_dir: str):
         self.image_dir = Path(image_dir)
         self.images = self._load_images()
-        self.positions = []
+        self.positions = np.empty((0, 2))  # (N, 2) array of x, y
         self.connections = []
 
     def _load_images(self) -> List[Path]:
@@ -58,83 +69,163 @@ class FloorPlanGenerator:
 
         print(f"Floor plan saved to: {output_file}")
 
-    def _linear_layout(self) -> List[Tuple[float, float]]:
+    def _linear_layout(self) -> np.ndarray:
         """Simple linear layout"""
-        positions = []
         spacing = 10.0
+        i = np.arange(len(self.images))
 
-        for i in range(len(self.images)):
-            x = i * spacing
-            y = 0
-            positions.append((x, y))
+        positions = np.zeros((len(i), 2))
+        positions[:, 0] = i * spacing
 
         return positions
 
-    def _serpentine_layout(self) -> List[Tuple[float, float]]:
+    def _serpentine_layout(self) -> np.ndarray:
         """Serpentine (snake) layout"""
-        positions = []
         spacing = 10.0
         width = 10  # Number of images per row
+        row, col = np.divmod(np.arange(len(self.images)), width)
 
-        for i in range(len(self.images)):
-            row = i // width
-            col = i % width
-
-            # Alternate direction for each row
-            if row % 2 == 0:
-                x = col * spacing
-            else:
-                x = (width - 1 - col) * spacing
-
-            y = row * spacing
-
-            positions.append((x, y))
+        # Alternate direction for each row, written straight into the output columns
+        positions = np.empty((len(row), 2))
+        np.multiply(np.where(row & 1, width - 1 - col, col), spacing, out=positions[:, 0])
+        np.multiply(row, spacing, out=positions[:, 1])
 
         return positions
 
-    def _grid_layout(self) -> List[Tuple[float, float]]:
+    def _grid_layout(self) -> np.ndarray:
         """Regular grid layout"""
-        positions = []
         spacing = 10.0
-        width = int(np.ceil(np.sqrt(len(self.images))))
+        width = max(1, int(np.ceil(np.sqrt(len(self.images)))))
+        row, col = np.divmod(np.arange(len(self.images)), width)
 
-        for i in range(len(self.images)):
-            row = i // width
-            col = i % width
-            positions.append((col * spacing, row * spacing))
+        positions = np.empty((len(row), 2))
+        np.multiply(col, spacing, out=positions[:, 0])
+        np.multiply(row, spacing, out=positions[:, 1])
 
         return positions
 
-    def _auto_layout(self) -> List[Tuple[float, float]]:
+    def _auto_layout(self) -> np.ndarray:
         """
         Automatically determine layout by analyzing image sequence
         Uses image similarity to estimate movement path
         """
         print("Analyzing image sequence for path estimation...")
 
-        # For now, use serpentine layout as default
-        # In a full implementation, this would:
-        # 1. Analyze consecutive images for similarity
-        # 2. Detect turns based on feature matching
-        # 3. Estimate camera movement direction
-        # 4. Build a path that matches the actual floor layout
+        # Consecutive images are always linked; images that look alike are linked too, so
+        # returning to a spot pulls those parts of the path together. Without enough
+        # features to compare, keep the serpentine layout.
+        histograms = self._visual_word_histograms()
+        if histograms is None:
+            return self._serpentine_layout()
+
+        revisits = self._similar_pairs(histograms)
+        print(f"Found {len(revisits)} revisited spots")
+
+        return self._relax_layout(self._serpentine_layout(), revisits)
+
+    def _visual_word_histograms(self) -> np.ndarray:
+        """
+        L2-normalized bag-of-visual-words histogram of each image's ORB descriptors,
+        as an (N, VOCABULARY_SIZE) array; None if there is too little to build a vocabulary
+        """
+        if len(self.images) <= MIN_REVISIT_GAP + 1:
+            return None
+
+        # ORB is FAST keypoints with binary (BRIEF) descriptors; 1/8 scale is enough to
+        # recognise a place
+        orb = cv2.ORB_create(nfeatures=500)
+        descriptors = []
+        for img_path in self.images:
+            gray = cv2.imread(str(img_path), cv2.IMREAD_REDUCED_GRAYSCALE_8)
+            desc = orb.detectAndCompute(gray, None)[1] if gray is not None else None
+            descriptors.append(desc if desc is not None else np.empty((0, 32), np.uint8))
+
+        # Cluster a sample of descriptors, as 0/1 bit vectors, into the vocabulary
+        sample = np.concatenate(descriptors)
+        if len(sample) < VOCABULARY_SIZE * 10:
+            return None
+        if len(sample) > 50000:
+            sample = sample[np.random.default_rng(0).choice(len(sample), 50000, replace=False)]
+        cv2.setRNGSeed(0)
+        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 20, 1.0)
+        _, _, vocabulary = cv2.kmeans(np.unpackbits(sample, axis=1).astype(np.float32),
+                                      VOCABULARY_SIZE, None, criteria, 1, cv2.KMEANS_PP_CENTERS)
+
+        # Assign each descriptor to its nearest word (|v|^2 - 2 d.v ranks like |d - v|^2)
+        histograms = np.zeros((len(self.images), VOCABULARY_SIZE), np.float32)
+        vocabulary_sq = (vocabulary ** 2).sum(axis=1)
+        for i, desc in enumerate(descriptors):
+            if len(desc):
+                bits = np.unpackbits(desc, axis=1).astype(np.float32)
+                words = np.argmin(vocabulary_sq - 2 * bits @ vocabulary.T, axis=1)
+                histograms[i] = np.bincount(words, minlength=VOCABULARY_SIZE)
+
+        norms = np.linalg.norm(histograms, axis=1, keepdims=True)
+        np.divide(histograms, norms, out=histograms, where=norms > 0)
+        return histograms
+
+    def _similar_pairs(self, histograms: np.ndarray) -> np.ndarray:
+        """(M, 2) index pairs of images, at least MIN_REVISIT_GAP apart, that look alike"""
+        # Randomized KD-trees answer each top-k query in ~O(log N) instead of comparing all pairs
+        k = min(SIMILAR_NEIGHBOURS + 1, len(histograms))
+        index = cv2.flann_Index(histograms, dict(algorithm=1, trees=4))
+        neighbours, dist_sq = index.knnSearch(histograms, k, params={})
+
+        # For unit vectors |a - b|^2 = 2 - 2 cos(a, b)
+        i = np.repeat(np.arange(len(histograms)), k)
+        j = neighbours.ravel().astype(np.int64)
+        similarity = 1 - dist_sq.ravel() / 2
+        has_words = histograms.any(axis=1)
+        keep = ((j >= 0) & (np.abs(i - j) >= MIN_REVISIT_GAP) & (similarity >= SIMILARITY_THRESHOLD))
+        keep[keep] &= has_words[i[keep]] & has_words[j[keep]]
+
+        pairs = np.sort(np.stack([i[keep], j[keep]], axis=1), axis=1)
+        return np.unique(pairs, axis=0)
+
+    def _relax_layout(self, positions: np.ndarray, links: np.ndarray,
+                      spacing: float = 10.0, iterations: int = 300) -> np.ndarray:
+        """
+        Move positions to settle a spring network: every consecutive pair and every linked
+        pair is a spring of rest length spacing
+        """
+        n = len(positions)
+        steps = np.stack([np.arange(n - 1), np.arange(1, n)], axis=1)
+        springs = np.concatenate([steps, links]) if len(links) else steps
+        a, b = springs[:, 0], springs[:, 1]
+
+        # Each node moves by its averaged spring pull, which keeps the iteration stable
+        degree = np.bincount(a, minlength=n) + np.bincount(b, minlength=n)
+        rate = 0.5 / np.maximum(degree, 1)
+
+        positions = positions.copy()
+        for _ in range(iterations):
+            delta = positions[b] - positions[a]
+            length = np.maximum(np.hypot(delta[:, 0], delta[:, 1]), 1e-9)
+            pull = delta * ((length - spacing) / length)[:, None]
+            for axis in (0, 1):
+                positions[:, axis] += rate * (np.bincount(a, pull[:, axis], n) -
+                                              np.bincount(b, pull[:, axis], n))
 
-        return self._serpentine_layout()
+        return positions
 
     def _create_visualization(self, output_file: str):
         """Create the floor plan visualization"""
-        fig, ax = plt.subplots(figsize=(20, 15))
+        # A standalone Figure isn't registered with pyplot, so it is freed as soon as
+        # this method returns instead of lingering until an explicit close
+        fig = Figure(figsize=(20, 15))
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot(1, 1, 1)
         fig.patch.set_facecolor('#1a1a2e')
         ax.set_facecolor('#16213e')
 
         # Get bounds
-        if not self.positions:
+        if len(self.positions) == 0:
             print("No positions to visualize")
             return
 
-        xs, ys = zip(*self.positions)
-        min_x, max_x = min(xs) - 5, max(xs) + 5
-        min_y, max_y = min(ys) - 5, max(ys) + 5
+        xs, ys = self.positions[:, 0], self.positions[:, 1]
+        min_x, max_x = xs.min() - 5, xs.max() + 5
+        min_y, max_y = ys.min() - 5, ys.max() + 5
 
         # Set limits
         ax.set_xlim(min_x, max_x)
@@ -144,28 +235,28 @@ class FloorPlanGenerator:
         # Draw grid
         ax.grid(True, alpha=0.2, color='white', linestyle='--')
 
-        # Draw path connections
+        # Draw path connections. Path and markers can run to thousands of primitives, so
+        # both are rasterized in vector outputs (PDF/SVG); text and start/end stay vector
         if len(self.positions) > 1:
-            segments = []
-            for i in range(len(self.positions) - 1):
-                segments.append([self.positions[i], self.positions[i + 1]])
+            # (N-1, 2, 2) array of consecutive position pairs
+            segments = np.stack([self.positions[:-1], self.positions[1:]], axis=1)
 
-            lc = LineCollection(segments, colors='#667eea', linewidths=3, alpha=0.6)
+            lc = LineCollection(segments, colors='#667eea', linewidths=3, alpha=0.6, rasterized=True)
             ax.add_collection(lc)
 
-        # Draw image positions
-        for i, (x, y) in enumerate(self.positions):
-            # Draw marker
-            circle = Circle((x, y), 0.8, color='#764ba2', ec='white', linewidth=2, zorder=10)
-            ax.add_patch(circle)
+        # Draw image positions (one collection for all markers)
+        ax.scatter(self.positions[:, 0], self.positions[:, 1], s=160, c='#764ba2',
+                   edgecolors='white', linewidths=2, zorder=10, rasterized=True)
 
-            # Add label for every 10th image or first/last
-            if i % 10 == 0 or i == 0 or i == len(self.positions) - 1:
-                ax.text(x, y - 2, f'{i + 1}', ha='center', va='top',
-                       color='white', fontsize=10, fontweight='bold')
+        # Add label for every 10th image or first/last
+        labeled = sorted(set(range(0, len(self.positions), 10)) | {len(self.positions) - 1})
+        for i in labeled:
+            x, y = self.positions[i]
+            ax.text(x, y - 2, f'{i + 1}', ha='center', va='top',
+                   color='white', fontsize=10, fontweight='bold')
 
         # Highlight start and end
-        if self.positions:
+        if len(self.positions):
             # Start (green)
             start_circle = Circle(self.positions[0], 1.2, color='#00ff00',
                                 ec='white', linewidth=3, zorder=11, alpha=0.7)
@@ -194,13 +285,13 @@ class FloorPlanGenerator:
 
         # Add legend
         legend_elements = [
-            plt.Line2D([0], [0], marker='o', color='w', label='Image Position',
-                      markerfacecolor='#764ba2', markersize=10, linestyle='None'),
-            plt.Line2D([0], [0], color='#667eea', linewidth=3, label='Path'),
-            plt.Line2D([0], [0], marker='o', color='w', label='Start',
-                      markerfacecolor='#00ff00', markersize=12, linestyle='None'),
-            plt.Line2D([0], [0], marker='o', color='w', label='End',
-                      markerfacecolor='#ff0000', markersize=12, linestyle='None'),
+            Line2D([0], [0], marker='o', color='w', label='Image Position',
+                  markerfacecolor='#764ba2', markersize=10, linestyle='None'),
+            Line2D([0], [0], color='#667eea', linewidth=3, label='Path'),
+            Line2D([0], [0], marker='o', color='w', label='Start',
+                  markerfacecolor='#00ff00', markersize=12, linestyle='None'),
+            Line2D([0], [0], marker='o', color='w', label='End',
+                  markerfacecolor='#ff0000', markersize=12, linestyle='None'),
         ]
         ax.legend(handles=legend_elements, loc='upper right',
                  facecolor='#1a1a2e', edgecolor='white', fontsize=10,
@@ -216,43 +307,59 @@ class FloorPlanGenerator:
         ax.text(0.02, 0.98, info_text, transform=ax.transAxes,
                fontsize=11, verticalalignment='top', bbox=props, color='white')
 
-        plt.tight_layout()
-        plt.savefig(output_file, dpi=300, facecolor=fig.get_facecolor(), edgecolor='none')
-        plt.close()
+        # Much of a 6000x4500 PNG save goes to zlib; fast compression trades file size for it
+        save_kwargs = {}
+        if Path(output_file).suffix.lower() == '.png':
+            save_kwargs = {'metadata': {'Software': None},
+                           'pil_kwargs': {'optimize': False, 'compress_level': 1}}
+
+        fig.tight_layout()
+        fig.savefig(output_file, dpi=300, facecolor=fig.get_facecolor(), edgecolor='none',
+                    **save_kwargs)
+        del fig
 
     def export_coordinates(self, output_file: str = 'floor_plan_coords.json'):
         """Export position coordinates to JSON"""
-        data = {
+        header = {
             'building': 'StanGrad',
             'floor': 2,
             'wing': 'MB Wing',
-            'total_images': len(self.images),
-            'positions': []
+            'total_images': len(self.images)
         }
 
-        for i, ((x, y), img_path) in enumerate(zip(self.positions, self.images)):
-            data['positions'].append({
-                'id': i + 1,
-                'filename': img_path.name,
-                'coordinates': {'x': float(x), 'y': float(y)},
-                'connections': []
-            })
-
-            # Add connections to adjacent images
-            if i > 0:
-                data['positions'][i]['connections'].append({
-                    'target_id': i,
-                    'direction': 'back'
-                })
-
-            if i < len(self.images) - 1:
-                data['positions'][i]['connections'].append({
-                    'target_id': i + 2,
-                    'direction': 'forward'
-                })
-
+        # Positions are written one record at a time rather than built up as one big dict;
+        # the layout matches json.dump(..., indent=2) of the whole document
         with open(output_file, 'w') as f:
-            json.dump(data, f, indent=2)
+            f.write(json.dumps(header, indent=2)[:-2] + ',\n  "positions": [')
+
+            n = len(self.images)
+            sep = '\n'
+            for i, ((x, y), img_path) in enumerate(zip(self.positions, self.images)):
+                record = {
+                    'id': i + 1,
+                    'filename': img_path.name,
+                    'coordinates': {'x': float(x), 'y': float(y)},
+                    'connections': []
+                }
+
+                # Add connections to adjacent images
+                if i > 0:
+                    record['connections'].append({
+                        'target_id': i,
+                        'direction': 'back'
+                    })
+
+                if i < n - 1:
+                    record['connections'].append({
+                        'target_id': i + 2,
+                        'direction': 'forward'
+                    })
+
+                f.write(sep + textwrap.indent(json.dumps(record, indent=2), '    '))
+                sep = ',\n'
+
+            # Empty lists dump as "[]", non-empty ones close on their own line
+            f.write(']\n}' if sep == '\n' else '\n  ]\n}')
 
         print(f"Coordinates exported to: {output_file}")
 
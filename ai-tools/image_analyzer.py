@@ -6,21 +6,59 @@ Analyzes panoramic images to extract features and metadata
 
 import os
 import json
+import mmap
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from typing import Dict, List, Tuple
 import cv2
 import numpy as np
-from PIL import Image
-import imagehash
+from tqdm import tqdm
+
+# Structural features are detected at this working width (pixels). Door rectangles stop
+# matching the full-resolution counts much below half of a 12k panorama, and the
+# full-resolution decode costs far more than detection at this size anyway
+ANALYSIS_WIDTH = 6144
+
+# Version of the analysis results stored in the cache file; bump it whenever the analysis
+# code or its thresholds change so older cached results are discarded
+CACHE_VERSION = 2
+
+
+def _downscale_for_analysis(gray: np.ndarray) -> Tuple[np.ndarray, float]:
+    """Shrink gray by the smallest integer factor that makes it at most ANALYSIS_WIDTH wide;
+    returns (gray, scale)"""
+    height, width = gray.shape[:2]
+    factor = -(-width // ANALYSIS_WIDTH)
+    if factor <= 1:
+        return gray, 1.0
+    # An integer factor keeps INTER_AREA a plain box filter, which preserves thin edges
+    size = (max(1, width // factor), max(1, height // factor))
+    return cv2.resize(gray, size, interpolation=cv2.INTER_AREA), 1.0 / factor
 
 
 class ImageAnalyzer:
     """Analyzes panoramic images for features and metadata"""
 
-    def __init__(self, confidence_threshold: float = 0.5):
+    def __init__(self, confidence_threshold: float = 0.5, cache_file: str = None):
         self.confidence_threshold = confidence_threshold
+
+        # Analysis results by path, stored as [[mtime, size], result] and reused while the
+        # file is unchanged; persisted to cache_file (JSON) if one is given. A cache written
+        # by a different analysis version or working width is ignored.
+        self.cache_file = Path(cache_file) if cache_file else None
         self.feature_cache = {}
+        if self.cache_file and self.cache_file.exists():
+            with open(self.cache_file) as f:
+                stored = json.load(f)
+            if stored.get('version') == CACHE_VERSION and stored.get('analysis_width') == ANALYSIS_WIDTH:
+                self.feature_cache = stored['results']
+
+    def __getstate__(self) -> Dict:
+        # Worker processes only analyze cache misses, so don't ship the cache to them
+        state = self.__dict__.copy()
+        state['feature_cache'] = {}
+        return state
 
     def analyze_image(self, image_path: str) -> Dict:
         """
@@ -33,37 +71,48 @@ class ImageAnalyzer:
             Dictionary containing analysis results
         """
         try:
+            # Skip the analysis entirely if the file is unchanged since it was cached
+            cache_key = self._cache_key(image_path)
+            cached = self._cached_result(image_path, cache_key)
+            if cached is not None:
+                return cached
+
             # Load image
-            img = cv2.imread(image_path)
-            if img is None:
-                raise ValueError(f"Could not load image: {image_path}")
+            img = self._load_image(image_path)
 
             # Basic metadata
             height, width, channels = img.shape
-            file_size = os.path.getsize(image_path)
+            file_size = cache_key[1]
+
+            # Convert to grayscale once; every later step reuses it
+            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
 
             # Calculate image hash for similarity detection
-            pil_img = Image.open(image_path)
-            img_hash = str(imagehash.average_hash(pil_img))
+            img_hash = f"{self._average_hash(gray):016x}"
+
+            # Doors, long lines and corners are scale-stable, so look for them on a smaller copy
+            work_gray, scale = _downscale_for_analysis(gray)
 
             # Detect features
-            features = self._detect_features(img)
+            features = self._detect_features(work_gray, scale)
 
-            # Analyze brightness and contrast
-            brightness = np.mean(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY))
-            contrast = np.std(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY))
+            # Analyze brightness and contrast (one pass over gray)
+            mean, std = cv2.meanStdDev(gray)
+            brightness = mean[0][0]
+            contrast = std[0][0]
 
             # Detect dominant colors
             dominant_colors = self._get_dominant_colors(img)
 
-            # Edge detection for structural analysis
-            edges = self._detect_edges(img)
-            edge_density = np.sum(edges > 0) / edges.size
+            # Edge detection for structural analysis; Canny edges stay ~1px wide, so scale the
+            # density back to its full-resolution equivalent
+            edges = self._detect_edges(work_gray)
+            edge_density = cv2.countNonZero(edges) / edges.size * scale
 
             # Estimate image type based on features
             image_type = self._classify_image_type(features, edge_density, brightness)
 
-            return {
+            result = {
                 'path': image_path,
                 'filename': os.path.basename(image_path),
                 'dimensions': {'width': width, 'height': height},
@@ -77,6 +126,8 @@ class ImageAnalyzer:
                 'type': image_type,
                 'status': 'success'
             }
+            self.feature_cache[image_path] = [cache_key, result]
+            return result
 
         except Exception as e:
             return {
@@ -86,8 +137,67 @@ class ImageAnalyzer:
                 'error': str(e)
             }
 
-    def _detect_features(self, img: np.ndarray) -> Dict:
-        """Detect features in the image"""
+    def _load_image(self, image_path: str, flags: int = cv2.IMREAD_COLOR) -> np.ndarray:
+        """Decode an image straight from a read-only memory map of the file"""
+        with open(image_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            buf = np.frombuffer(mm, dtype=np.uint8)
+            img = cv2.imdecode(buf, flags)
+            del buf  # the map can only close once no array views it
+        if img is None:
+            raise ValueError(f"Could not load image: {image_path}")
+        return img
+
+    def _cache_key(self, image_path: str) -> List[float]:
+        """[mtime, size] of the file, which changes whenever its content is replaced"""
+        stat = os.stat(image_path)
+        return [stat.st_mtime, stat.st_size]
+
+    def _cached_result(self, image_path: str, cache_key: List[float]) -> Dict:
+        """Cached analysis for image_path if it was made for the same cache_key, else None"""
+        entry = self.feature_cache.get(image_path)
+        if entry is not None and entry[0] == cache_key:
+            return entry[1]
+        return None
+
+    def save_cache(self):
+        """Write the analysis cache back to cache_file"""
+        if self.cache_file:
+            with open(self.cache_file, 'w') as f:
+                json.dump({'version': CACHE_VERSION, 'analysis_width': ANALYSIS_WIDTH,
+                           'results': self.feature_cache}, f)
+
+    def _average_hash(self, gray: np.ndarray) -> int:
+        """64-bit average hash (same scheme as imagehash.average_hash) of a grayscale image"""
+        small = cv2.resize(gray, (8, 8), interpolation=cv2.INTER_AREA)
+        bits = (small > small.mean()).ravel()
+        return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+    def _quick_hash(self, image_path: str) -> int:
+        """Average hash from a 1/8-scale grayscale decode, or None if the file can't be read"""
+        try:
+            return self._average_hash(self._load_image(image_path, cv2.IMREAD_REDUCED_GRAYSCALE_8))
+        except (OSError, ValueError):
+            return None
+
+    def _find_duplicates(self, hashes: List[int], threshold: int) -> Dict[int, int]:
+        """
+        Map each image index to the earlier image whose analysis it can reuse
+
+        An image is a near-duplicate when its hash is within threshold bits of the frame
+        whose analysis the preceding run of duplicates reuses, so gradual changes (a slow
+        pan) can't drift arbitrarily far from that frame.
+        """
+        duplicates = {}
+        src = None
+        for i, h in enumerate(hashes):
+            if h is not None and src is not None and (h ^ hashes[src]).bit_count() <= threshold:
+                duplicates[i] = src
+            else:
+                src = i if h is not None else None
+        return duplicates
+
+    def _detect_features(self, gray: np.ndarray, scale: float = 1.0) -> Dict:
+        """Detect features in a grayscale image resized by scale (pixel thresholds follow it)"""
         features = {
             'doors': [],
             'windows': [],
@@ -96,31 +206,35 @@ class ImageAnalyzer:
             'lines': []
         }
 
-        # Convert to grayscale
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-
-        # Detect corners using Harris corner detection
-        corners = cv2.goodFeaturesToTrack(gray, maxCorners=100, qualityLevel=0.01, minDistance=10)
-        if corners is not None:
-            features['corners'] = len(corners)
+        # Count corners with FAST (intensity comparisons only, no per-window eigenvalues)
+        fast = cv2.FastFeatureDetector_create(threshold=20)
+        features['corners'] = len(fast.detect(gray, None))
 
         # Detect lines using Hough transform
         edges = cv2.Canny(gray, 50, 150, apertureSize=3)
-        lines = cv2.HoughLinesP(edges, 1, np.pi/180, threshold=100, minLineLength=100, maxLineGap=10)
+        lines = cv2.HoughLinesP(edges, 1, np.pi/180, threshold=max(1, int(100 * scale)),
+                                minLineLength=100 * scale, maxLineGap=max(1.0, 10 * scale))
         if lines is not None:
             features['lines'] = len(lines)
 
         # Detect rectangular shapes (potential doors/windows)
         contours, _ = cv2.findContours(edges, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
         rectangles = []
+        min_area = 1000 * scale ** 2
         for contour in contours:
+            # The polygon's vertices are contour points, so its box can't exceed the contour's;
+            # most contours are small noise and are rejected here before approxPolyDP
+            _, _, w, h = cv2.boundingRect(contour)
+            if w * h <= min_area:
+                continue
+
             perimeter = cv2.arcLength(contour, True)
             approx = cv2.approxPolyDP(contour, 0.02 * perimeter, True)
             if len(approx) == 4:  # Rectangle
                 x, y, w, h = cv2.boundingRect(approx)
                 aspect_ratio = float(w) / h if h > 0 else 0
                 # Doors typically have aspect ratio between 0.3 and 0.7
-                if 0.3 < aspect_ratio < 0.7 and w * h > 1000:
+                if 0.3 < aspect_ratio < 0.7 and w * h > min_area:
                     rectangles.append({'x': int(x), 'y': int(y), 'w': int(w), 'h': int(h)})
 
         features['doors'] = len(rectangles)
@@ -129,23 +243,29 @@ class ImageAnalyzer:
 
     def _get_dominant_colors(self, img: np.ndarray, k: int = 3) -> List[Tuple[int, int, int]]:
         """Extract dominant colors from the image"""
-        # Reshape image to be a list of pixels
-        pixels = img.reshape((-1, 3))
-        pixels = np.float32(pixels)
+        # A small thumbnail is plenty for a color summary
+        small = cv2.resize(img, (128, 128), interpolation=cv2.INTER_AREA)
+
+        # Quantize each BGR channel to 2 bits and histogram the 64 resulting bins
+        q = (small >> 6).astype(np.uint32)
+        idx = (q[..., 0] << 4) | (q[..., 1] << 2) | q[..., 2]
+        counts = np.bincount(idx.ravel(), minlength=64)
 
-        # K-means clustering
-        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 100, 0.2)
-        _, labels, centers = cv2.kmeans(pixels, k, None, criteria, 10, cv2.KMEANS_RANDOM_CENTERS)
+        # Most populated bins first; empty bins are never dominant
+        top = np.argpartition(counts, -k)[-k:]
+        top = top[np.argsort(counts[top])[::-1]]
+        top = top[counts[top] > 0]
 
-        # Convert to list of RGB tuples
-        centers = np.uint8(centers)
-        dominant_colors = [tuple(map(int, color[::-1])) for color in centers]  # BGR to RGB
+        # Convert bin centers to list of RGB tuples
+        b = ((top >> 4) & 3) * 64 + 32
+        g = ((top >> 2) & 3) * 64 + 32
+        r = (top & 3) * 64 + 32
+        dominant_colors = [(int(cr), int(cg), int(cb)) for cr, cg, cb in zip(r, g, b)]
 
         return dominant_colors
 
-    def _detect_edges(self, img: np.ndarray) -> np.ndarray:
-        """Detect edges in the image"""
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    def _detect_edges(self, gray: np.ndarray) -> np.ndarray:
+        """Detect edges in an already grayscale image"""
         edges = cv2.Canny(gray, 100, 200)
         return edges
 
@@ -165,30 +285,83 @@ class ImageAnalyzer:
         else:
             return 'unknown'
 
-    def batch_analyze(self, image_dir: str, output_file: str = None) -> List[Dict]:
+    def batch_analyze(self, image_dir: str, output_file: str = None, workers: int = None,
+                      dedup_threshold: int = 3) -> List[Dict]:
         """
         Analyze multiple images in a directory
 
         Args:
             image_dir: Directory containing images
             output_file: Optional JSON file to save results
+            workers: Number of worker processes (defaults to the CPU count)
+            dedup_threshold: Consecutive images whose hashes differ by at most this many
+                bits reuse the previous analysis (negative disables)
 
         Returns:
             List of analysis results
         """
         image_dir = Path(image_dir)
-        results = []
 
-        # Find all image files
+        # Find all image files, in capture order so bursts of the same spot are adjacent
         image_extensions = {'.jpg', '.jpeg', '.png', '.bmp'}
-        image_files = [f for f in image_dir.glob('*') if f.suffix.lower() in image_extensions]
+        image_files = sorted(f for f in image_dir.glob('*') if f.suffix.lower() in image_extensions)
 
         print(f"Found {len(image_files)} images to analyze")
 
-        for img_file in image_files:
-            print(f"Analyzing: {img_file.name}")
-            result = self.analyze_image(str(img_file))
-            results.append(result)
+        # Unchanged files are answered from the cache; only the rest are analyzed
+        paths = [str(f) for f in image_files]
+        results = [None] * len(paths)
+        cache_keys = [None] * len(paths)
+        for i, path in enumerate(paths):
+            try:
+                cache_keys[i] = self._cache_key(path)
+            except OSError:
+                continue
+            results[i] = self._cached_result(path, cache_keys[i])
+        pending = [i for i, result in enumerate(results) if result is None]
+        if len(pending) < len(paths):
+            print(f"Reusing cached analysis for {len(paths) - len(pending)} unchanged images")
+
+        # Images are independent, so analyze them across processes (map keeps input order).
+        # Chunks amortize IPC but stay small enough to spread short batches over all workers.
+        workers = workers or os.cpu_count()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # Near-identical consecutive frames (found with a cheap hash) copy the analysis
+            # of the frame they repeat instead of running the full pipeline again
+            duplicates = {}
+            if dedup_threshold >= 0 and pending:
+                hashes = [None] * len(paths)
+                for i, result in enumerate(results):
+                    if result is not None and result['status'] == 'success':
+                        hashes[i] = int(result['hash'], 16)
+                chunksize = max(1, min(8, len(pending) // (workers * 4)))
+                for i, h in zip(pending, executor.map(self._quick_hash, [paths[i] for i in pending],
+                                                      chunksize=chunksize)):
+                    hashes[i] = h
+                duplicates = {i: src for i, src in self._find_duplicates(hashes, dedup_threshold).items()
+                              if results[i] is None}
+                if duplicates:
+                    print(f"Skipping analysis of {len(duplicates)} near-duplicate images")
+
+            to_analyze = [i for i in pending if i not in duplicates]
+            chunksize = max(1, min(8, len(to_analyze) // (workers * 4)))
+            analyses = executor.map(self.analyze_image, [paths[i] for i in to_analyze], chunksize=chunksize)
+            for i, result in zip(to_analyze, tqdm(analyses, total=len(to_analyze), desc="Analyzing images")):
+                results[i] = result
+                if result['status'] == 'success':
+                    self.feature_cache[paths[i]] = [cache_keys[i], result]
+
+        # Duplicates are filled in order, so a source earlier in the list is always ready.
+        # The copies aren't cached: they depend on dedup_threshold, which isn't in the cache key.
+        for i, src in sorted(duplicates.items()):
+            if results[src]['status'] != 'success':
+                results[i] = self.analyze_image(paths[i])
+                continue
+            results[i] = dict(results[src], path=paths[i], filename=os.path.basename(paths[i]),
+                              file_size=cache_keys[i][1], hash=f"{hashes[i]:016x}",
+                              duplicate_of=results[src]['path'])
+
+        self.save_cache()
 
         # Save results if output file specified
         if output_file:
@@ -205,19 +378,25 @@ def main():
     parser.add_argument('--batch', type=str, help='Directory of images to analyze')
     parser.add_argument('--output', type=str, help='Output JSON file for results')
     parser.add_argument('--confidence', type=float, default=0.5, help='Confidence threshold')
+    parser.add_argument('--workers', type=int, help='Number of worker processes (default: CPU count)')
+    parser.add_argument('--cache', type=str, help='JSON file caching results of unchanged images between runs')
+    parser.add_argument('--dedup-threshold', type=int, default=3,
+                       help='Max hash bit difference for a frame to reuse the previous analysis (-1 disables)')
 
     args = parser.parse_args()
 
-    analyzer = ImageAnalyzer(confidence_threshold=args.confidence)
+    analyzer = ImageAnalyzer(confidence_threshold=args.confidence, cache_file=args.cache)
 
     if args.image:
         # Analyze single image
         result = analyzer.analyze_image(args.image)
+        analyzer.save_cache()
         print(json.dumps(result, indent=2))
 
     elif args.batch:
         # Batch analyze
-        results = analyzer.batch_analyze(args.batch, args.output)
+        results = analyzer.batch_analyze(args.batch, args.output, workers=args.workers,
+                                         dedup_threshold=args.dedup_threshold)
         print(f"\nAnalyzed {len(results)} images")
         success_count = sum(1 for r in results if r['status'] == 'success')
         print(f"Success: {success_count}/{len(results)}")